@@ -1,27 +1,58 @@
+import os
 import re
+import mmap
 import time
+import atexit
 import socket
 import struct
 import logging
 import traceback
+from array import array
+from hashlib import md5
+from random import random
+from bisect import bisect
+from math import copysign
 from functools import wraps
+from itertools import izip
+from optparse import OptionParser
 from Queue import Queue, Empty
 from collections import defaultdict
-from threading import RLock, Thread, Semaphore
+from threading import RLock, Thread, Semaphore, Event
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 __all__ = ["Connection", "start_threads"]
 
-__version_info__ = (1, 0, 2, "final", 0)
+__version_info__ = (1, 1, 0, "final", 0)
 __version__ = "{0}.{1}.{2}".format(*__version_info__)
 
 logger = logging.getLogger("collectd")
 
 SEND_INTERVAL = 10      # seconds
 MAX_PACKET_SIZE = 1024  # bytes
+GAUGE_TIME_BUDGET = 1   # seconds
+MIN_SNAPSHOT_INTERVAL = 1  # seconds
+
+PUTVAL_BATCH_SIZE = 1000  # lines
+UNIXSOCK_TIMEOUT = 5      # seconds
+
+SPOOL_SYNC_INTERVAL = 1   # seconds
+SPOOL_HEADER = struct.Struct("!I")
+
+HASH_RING_REPLICAS = 160  # points on the hash ring for each destination
 
 PLUGIN_TYPE = "gauge"
 
+EMPTY_AGGREGATE = array("d", [float("inf"), float("-inf"), 0.0, 0.0])
+
+# counters which track idle series reset their values to negative zero, which
+# recording or setting any value (even zero) turns into something else
+UNTOUCHED = -0.0
+
 TYPE_HOST            = 0x0000
 TYPE_TIME            = 0x0001
 TYPE_PLUGIN          = 0x0002
@@ -68,6 +99,9 @@ def pack(id, value):
     else:
         raise AssertionError("invalid type code " + str(id))
 
+# the size of a packed value apart from its category, specific and stat names
+VALUE_OVERHEAD = len(pack_value("--", 0.0))
+
 def message_start(when=None, host=socket.gethostname(), plugin_inst="", plugin_name="any"):
     return "".join([
         pack(TYPE_HOST, host),
@@ -94,11 +128,77 @@ def messages(counts, when=None, host=socket.gethostname(), plugin_inst="", plugi
         packets.append("".join(curr))
     return packets
 
+def quote(s):
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def putval(name, value, when, host, plugin_inst, plugin_name):
+    plugin = plugin_name + ("-" + plugin_inst if plugin_inst else "")
+    ident = "/".join([host, plugin, PLUGIN_TYPE + "-" + name])
+    return "PUTVAL {0} interval={1} {2}:{3!r}\n".format(quote(ident), SEND_INTERVAL,
+                                                       int(when), float(value))
+
+def putvals(counts, when=None, host=socket.gethostname(), plugin_inst="", plugin_name="any"):
+    when = when or time.time()
+    return [putval(name, count, when, host, plugin_inst, plugin_name)
+            for name,count in counts.items()]
+
 
 
 def sanitize(s):
     return re.sub(r"[^a-zA-Z0-9]+", "_", s).strip("_")
 
+def untouched(value):
+    return value == 0.0 and copysign(1.0, value) < 0
+
+# returns {specific: {stat: sum}} with the overall sums under the "" specific,
+# just as if record(specifics[i], **columns[i]) had been called for each row
+def group_sums(specifics, columns):
+    rows = len(specifics) if specifics is not None else None
+    for col in columns.values():
+        rows = len(col) if rows is None else rows
+        assert len(col) == rows, "all columns must be the same length"
+    if not rows:
+        return {}
+    
+    # converting python lists into arrays costs more than it saves, so we
+    # only take the vectorized path when we were given arrays to begin with
+    arrays = numpy is not None and any(isinstance(seq, numpy.ndarray)
+                                       for seq in [specifics] + columns.values())
+    group_by = _group_by_numpy if arrays else _group_by
+    sums = {"": {}}
+    for stat, (total, grouped) in group_by(specifics, columns).items():
+        sums[""][stat] = total
+        for specific, subtotal in grouped.items():
+            group = sums.setdefault(specific, {})
+            group[stat] = group.get(stat, 0) + subtotal
+    return sums
+
+def _group_by(specifics, columns):
+    results = {}
+    for stat, col in columns.items():
+        grouped = defaultdict(int)
+        if specifics is not None:
+            for specific, value in izip(specifics, col):
+                grouped[specific] += value
+        results[stat] = (sum(col), grouped)
+    return results
+
+def _group_by_numpy(specifics, columns):
+    if specifics is not None:
+        keys, inverse = numpy.unique(numpy.asarray(specifics), return_inverse = True)
+        keys = keys.tolist()
+    
+    results = {}
+    for stat, col in columns.items():
+        col = numpy.asarray(col)
+        assert col.dtype.kind in "biuf", "columns must be numeric"
+        grouped = {}
+        if specifics is not None:
+            totals = numpy.bincount(inverse, weights = col, minlength = len(keys))
+            grouped = dict(zip(keys, totals.tolist()))
+        results[stat] = (float(col.sum()), grouped)
+    return results
+
 def swallow_errors(func):
     @wraps(func)
     def wrapped(*args, **kwargs):
@@ -118,38 +218,429 @@ def synchronized(method):
             return method(self, *args, **kwargs)
     return wrapped
 
+class GaugeEvaluation(Thread):
+    def __init__(self, name, func):
+        Thread.__init__(self, name = "gauge " + name)
+        self.daemon = True
+        self.gauge_name = name
+        self.func = func
+        self.value = None
+    
+    def run(self):
+        try:
+            value = self.func()
+            assert isinstance(value, (int, float))
+            self.value = value
+        except:
+            logger.error("error evaluating gauge %s", self.gauge_name, exc_info = True)
+
 class Counter(object):
-    def __init__(self, category):
+    def __init__(self, category, sample_rate = 1.0, on_new_series = None):
         self.category = category
+        self.sample_rate = sample_rate
         self._lock = RLock()
-        self.counts = defaultdict(lambda: defaultdict(float))
+        self._on_new_series = on_new_series
+        self.gauges = {}
+        self._running_gauges = {}
+        
+        # each (specific, stat) pair is interned into an index into a flat
+        # array of doubles, which is far smaller than a dict of boxed floats
+        self._slots = {}
+        self._values = array("d")
+        
+        # aggregates use 4 consecutive doubles: min, max, sum and count
+        self._aggregate_slots = {}
+        self._aggregates = array("d")
+        
+        # counters are only given on_new_series by connections which limit
+        # their pending series, and only then do they track which series are
+        # new, which were sent early and which have gone idle
+        self._new_slots = []
+        self._new_aggregate_slots = []
+        self._sent_early = set()
+        self._aggregates_sent_early = set()
+        self._free_slots = []
+        self._free_aggregate_slots = []
     
     @swallow_errors
-    @synchronized
     def record(self, *args, **kwargs):
+        self._record_sampled(self.sample_rate, args, kwargs)
+    
+    @swallow_errors
+    def record_sampled(self, sample_rate, *args, **kwargs):
+        self._record_sampled(sample_rate, args, kwargs)
+    
+    def _record_sampled(self, sample_rate, args, kwargs):
+        # the sampling decision is made before taking the lock so that a
+        # skipped call costs little more than a call to random()
+        assert isinstance(sample_rate, (int, float))
+        if sample_rate < 1.0:
+            if random() >= sample_rate:
+                return
+            self._record(1.0 / sample_rate, args, kwargs)
+        else:
+            self._record(1, args, kwargs)
+    
+    def _slot(self, specific, stat):
+        key = (specific, stat)
+        slot = self._slots.get(key)
+        if slot is None:
+            if self._free_slots:
+                slot = self._slots[key] = self._free_slots.pop()
+            else:
+                slot = self._slots[key] = len(self._values)
+                self._values.append(0.0)
+            if self._on_new_series:
+                self._new_slots.append(key)
+                self._new_series(1, specific, stat)
+        return slot
+    
+    def _aggregate_slot(self, stat):
+        slot = self._aggregate_slots.get(stat)
+        if slot is None:
+            if self._free_aggregate_slots:
+                slot = self._aggregate_slots[stat] = self._free_aggregate_slots.pop()
+            else:
+                slot = self._aggregate_slots[stat] = len(self._aggregates)
+                self._aggregates.extend(EMPTY_AGGREGATE)
+            if self._on_new_series:
+                self._new_aggregate_slots.append(stat)
+                self._new_series(3, "", stat + "-avg")
+        return slot
+    
+    def _new_series(self, count, specific, stat):
+        size = len(self.category) + len(specific) + len(stat) + VALUE_OVERHEAD
+        self._on_new_series(count, count * size)
+    
+    @synchronized
+    def _record(self, scale, args, kwargs):
+        values = self._values
         for specific in list(args) + [""]:
             assert isinstance(specific, basestring)
             for stat, value in kwargs.items():
                 assert isinstance(value, (int, float))
-                self.counts[str(specific)][str(stat)] += value
+                values[self._slot(str(specific), str(stat))] += value * scale
+    
+    @swallow_errors
+    def record_many(self, specifics, **columns):
+        self._merge(group_sums(specifics, columns))
+    
+    @synchronized
+    def _merge(self, sums):
+        for specific, stats in sums.items():
+            assert isinstance(specific, basestring)
+            for value in stats.values():
+                assert isinstance(value, (int, float))
+        
+        values = self._values
+        for specific, stats in sums.items():
+            for stat, value in stats.items():
+                values[self._slot(str(specific), str(stat))] += value
     
     @swallow_errors
     @synchronized
     def set_exact(self, **kwargs):
         for stat, value in kwargs.items():
             assert isinstance(value, (int, float))
-            self.counts[""][str(stat)] = value
+            self._values[self._slot("", str(stat))] = value
+    
+    @swallow_errors
+    @synchronized
+    def set_aggregate(self, **kwargs):
+        aggs = self._aggregates
+        for stat, value in kwargs.items():
+            assert isinstance(value, (int, float))
+            slot = self._aggregate_slot(str(stat))
+            if value < aggs[slot]:
+                aggs[slot] = value
+            if value > aggs[slot + 1]:
+                aggs[slot + 1] = value
+            aggs[slot + 2] += value
+            aggs[slot + 3] += 1
+    
+    @swallow_errors
+    @synchronized
+    def gauge(self, stat, func):
+        assert callable(func)
+        self.gauges[str(stat)] = func
+    
+    def snapshot(self, deadline = None):
+        return self._finish_snapshot(self._start_gauges(), deadline)
+    
+    def _finish_snapshot(self, evaluations, deadline):
+        polled = self._collect_gauges(evaluations, deadline)
+        totals = self._snapshot_counts()
+        totals.update(polled)
+        return totals
+    
+    def _name(self, specific, stat):
+        name_parts = map(sanitize, [self.category, specific, stat])
+        return "-".join(name_parts).replace("--", "-")
     
     @synchronized
-    def snapshot(self):
+    def _start_gauges(self):
+        # each gauge callback runs on its own thread without holding our
+        # lock, so a slow callback never blocks the threads which are
+        # recording statistics and a hung one is abandoned at the deadline
+        # rather than stalling the snapshot; it isn't started again until
+        # its previous call returns, so it can only ever tie up one thread
+        evaluations = []
+        for stat, func in self.gauges.items():
+            running = self._running_gauges.get(stat)
+            if running and running.is_alive():
+                logger.warning("gauge %s is still running from a previous snapshot, skipping it",
+                               running.gauge_name)
+                continue
+            evaluation = self._running_gauges[stat] = GaugeEvaluation(self._name("", stat), func)
+            evaluation.start()
+            evaluations.append(evaluation)
+        return evaluations
+    
+    def _collect_gauges(self, evaluations, deadline):
+        if deadline is None:
+            deadline = time.time() + GAUGE_TIME_BUDGET
+        polled = {}
+        for evaluation in evaluations:
+            evaluation.join(max(0, deadline - time.time()))
+            if evaluation.is_alive():
+                logger.warning("gauge time budget exhausted, skipping %s", evaluation.gauge_name)
+            elif evaluation.value is not None:
+                polled[evaluation.gauge_name] = evaluation.value
+        return polled
+    
+    @synchronized
+    def _snapshot_counts(self):
         totals = {}
-        for specific,counts in self.counts.items():
-            for stat in counts:
-                name_parts = map(sanitize, [self.category, specific, stat])
-                name = "-".join(name_parts).replace("--", "-")
-                totals[name] = counts[stat]
-                counts[stat] = 0.0
+        values = self._values
+        if self._on_new_series:
+            self._snapshot_tracked(totals)
+        else:
+            for (specific, stat), slot in self._slots.items():
+                totals[self._name(specific, stat)] = values[slot]
+            self._values = array("d", [0.0]) * len(values)
+        
+        for stat, slot in self._aggregate_slots.items():
+            self._aggregate_totals(totals, stat, slot)
+            if (self._on_new_series and not self._aggregates[slot + 3]
+                    and stat not in self._aggregates_sent_early):
+                del self._aggregate_slots[stat]
+                self._free_aggregate_slots.append(slot)
+        self._aggregates = EMPTY_AGGREGATE * (len(self._aggregates) // 4)
+        
+        self._new_slots, self._new_aggregate_slots = [], []
+        self._sent_early, self._aggregates_sent_early = set(), set()
         return totals
+    
+    def _snapshot_tracked(self, totals):
+        # series which haven't been recorded since they were last sent aren't
+        # sent again, and those which have been idle for a whole interval are
+        # forgotten and their slots reused; a series sent early only went idle
+        # partway through this interval, so it's kept until the next one
+        values = self._values
+        for key, slot in self._slots.items():
+            value = values[slot]
+            if not untouched(value):
+                totals[self._name(*key)] = value
+            elif key not in self._sent_early:
+                del self._slots[key]
+                self._free_slots.append(slot)
+        self._values = array("d", [UNTOUCHED]) * len(values)
+    
+    @synchronized
+    def snapshot_new(self):
+        # the series created since the last snapshot are sent and then kept
+        # like any other series, so that only series which are really new
+        # count towards the limits of our connection
+        totals = {}
+        values = self._values
+        for key in self._new_slots:
+            slot = self._slots[key]
+            totals[self._name(*key)] = values[slot]
+            values[slot] = UNTOUCHED
+        self._sent_early.update(self._new_slots)
+        
+        for stat in self._new_aggregate_slots:
+            slot = self._aggregate_slots[stat]
+            self._aggregate_totals(totals, stat, slot)
+            self._aggregates[slot : slot + 4] = EMPTY_AGGREGATE
+        self._aggregates_sent_early.update(self._new_aggregate_slots)
+        
+        self._new_slots, self._new_aggregate_slots = [], []
+        return totals
+    
+    def _aggregate_totals(self, totals, stat, slot):
+        lo, hi, total, count = self._aggregates[slot : slot + 4]
+        if count:
+            name = self._name("", stat)
+            totals[name + "-min"] = lo
+            totals[name + "-max"] = hi
+            totals[name + "-avg"] = total / count
+
+class UnixSocket(object):
+    def __init__(self, path):
+        self.path = path
+        self._lock = RLock()
+        self._sock = None
+        self._buffer = ""
+    
+    @synchronized
+    def send(self, lines):
+        for i in range(0, len(lines), PUTVAL_BATCH_SIZE):
+            batch = lines[i : i + PUTVAL_BATCH_SIZE]
+            try:
+                self._write(batch)
+            except socket.error:
+                logger.info("lost connection to %s, reconnecting", self.path)
+                self.close()
+                self._write(batch)
+            
+            # once the whole batch has been written collectd may already have
+            # processed it, so resending it would only get every line rejected
+            # as having the same timestamp as the value we already sent
+            try:
+                self._read_responses(batch)
+            except socket.error:
+                logger.warning("lost connection to %s while reading responses", self.path,
+                               exc_info = True)
+                self.close()
+    
+    @synchronized
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock, self._buffer = None, ""
+    
+    def _write(self, batch):
+        # the whole batch is written before reading any responses, so we pay
+        # for one round trip per batch rather than one per line
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(UNIXSOCK_TIMEOUT)
+            self._sock.connect(self.path)
+        self._sock.sendall("".join(batch))
+    
+    def _read_responses(self, batch):
+        for line in batch:
+            response = self._readline()
+            if not response.startswith("0 "):
+                logger.error("collectd rejected %r: %s", line.strip(), response)
+    
+    def _readline(self):
+        while "\n" not in self._buffer:
+            data = self._sock.recv(4096)
+            if not data:
+                raise socket.error("connection closed by " + self.path)
+            self._buffer += data
+        line, self._buffer = self._buffer.split("\n", 1)
+        return line
+
+class Spool(object):
+    def __init__(self, path):
+        self.path = path
+        self._lock = RLock()
+        self._file = open(path, "a+b")
+        self._last_sync = time.time()
+        self._truncate_partial()
+        atexit.register(self.close)
+    
+    def _truncate_partial(self):
+        # a crash in the middle of a write leaves a partial packet at the end,
+        # which we must discard so that the packets we append are readable
+        data = map_file(self._file)
+        if data:
+            end = 0
+            for start, end in spool_offsets(data):
+                pass
+            if end < len(data):
+                logger.warning("truncating partial packet at the end of %s", self.path)
+                self._file.truncate(end)
+            data.close()
+    
+    @synchronized
+    def append(self, packets):
+        # each packet is prefixed with its length and written with a single
+        # sequential write; the expensive fsync happens at most once for every
+        # SPOOL_SYNC_INTERVAL no matter how often we append
+        self._file.write("".join(SPOOL_HEADER.pack(len(p)) + p for p in packets))
+        self._file.flush()
+        if time.time() - self._last_sync >= SPOOL_SYNC_INTERVAL:
+            self.sync()
+    
+    @synchronized
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = time.time()
+    
+    @synchronized
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+def map_file(f):
+    if os.fstat(f.fileno()).st_size:
+        return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+def spool_offsets(data):
+    offset = 0
+    while offset + SPOOL_HEADER.size <= len(data):
+        [size] = SPOOL_HEADER.unpack_from(data, offset)
+        offset += SPOOL_HEADER.size
+        if offset + size > len(data):
+            break
+        yield offset, offset + size
+        offset += size
+
+def read_spool(path):
+    with open(path, "rb") as f:
+        data = map_file(f)
+    if data:
+        try:
+            for start, end in spool_offsets(data):
+                yield data[start:end]
+        finally:
+            data.close()
+
+def replay(path, collectd_host = "localhost", collectd_port = 25826, rate = None):
+    sent = 0
+    next_send = time.time()
+    for packet in read_spool(path):
+        if rate:
+            time.sleep(max(0, next_send - time.time()))
+            next_send += 1.0 / rate
+        sock.sendto(packet, (collectd_host, collectd_port))
+        sent += 1
+    return sent
+
+def replay_main(argv = None):
+    parser = OptionParser(usage = "%prog [options] SPOOL_FILE...",
+                          description = "Sends packets spooled by Connection(spool_file=...) to a collectd server.")
+    parser.add_option("--host", default = "localhost", help = "collectd server hostname [%default]")
+    parser.add_option("--port", default = 25826, type = "int", help = "collectd server port [%default]")
+    parser.add_option("--rate", default = 100, type = "float", help = "packets per second, or 0 for no limit [%default]")
+    options, paths = parser.parse_args(argv)
+    if not paths:
+        parser.error("no spool files given")
+    
+    for path in paths:
+        sent = replay(path, options.host, options.port, options.rate)
+        print "sent {0} packets from {1}".format(sent, path)
+
+def hash_key(key):
+    return struct.unpack("!Q", md5(key).digest()[:8])[0]
+
+class HashRing(object):
+    def __init__(self, nodes, replicas = HASH_RING_REPLICAS):
+        points = sorted((hash_key("{0}:{1}-{2}".format(host, port, i)), (host, port))
+                        for host, port in nodes for i in range(replicas))
+        self._hashes = [h for h, node in points]
+        self._nodes = [node for h, node in points]
+    
+    def get(self, key):
+        return self._nodes[bisect(self._hashes, hash_key(key)) % len(self._nodes)]
 
 class Connection(object):
     _lock = RLock() # class-level lock, only used for __new__
@@ -158,25 +649,63 @@ class Connection(object):
     @synchronized
     def __new__(cls, hostname = socket.gethostname(),
                      collectd_host = "localhost", collectd_port = 25826,
-                     plugin_inst = "", plugin_name = "any"):
-        id = (hostname, collectd_host, collectd_port, plugin_inst, plugin_name)
+                     plugin_inst = "", plugin_name = "any",
+                     collectd_socket = None, spool_file = None, spool_only = False,
+                     destinations = None, replicate = False,
+                     max_pending_series = None, max_pending_bytes = None):
+        destinations = tuple(map(tuple, destinations or []))
+        id = (hostname, collectd_host, collectd_port, plugin_inst, plugin_name,
+              collectd_socket, spool_file, spool_only, destinations, replicate,
+              max_pending_series, max_pending_bytes)
         if id in cls.instances:
             return cls.instances[id]
         else:
             inst = object.__new__(cls)
+            inst._id = id
             cls.instances[id] = inst
             return inst
     
     def __init__(self, hostname = socket.gethostname(),
                        collectd_host = "localhost", collectd_port = 25826,
-                       plugin_inst = "", plugin_name = "any"):
-        if "_counters" not in self.__dict__:
-            self._lock = RLock()
-            self._counters = {}
-            self._plugin_inst = plugin_inst
-            self._plugin_name = plugin_name
-            self._hostname = hostname
-            self._collectd_addr = (collectd_host, collectd_port)
+                       plugin_inst = "", plugin_name = "any",
+                       collectd_socket = None, spool_file = None, spool_only = False,
+                       destinations = None, replicate = False,
+                       max_pending_series = None, max_pending_bytes = None):
+        # __init__ runs under the class lock so that another thread which
+        # gets this instance from __new__ while we're still initializing it
+        # waits for us rather than initializing it a second time
+        with Connection._lock:
+            if "_counters" not in self.__dict__:
+                try:
+                    self._lock = RLock()
+                    self._plugin_inst = plugin_inst
+                    self._plugin_name = plugin_name
+                    self._hostname = hostname
+                    self._collectd_addr = (collectd_host, collectd_port)
+                    self._destinations = map(tuple, destinations or [self._collectd_addr])
+                    self._ring = None
+                    if len(self._destinations) > 1 and not replicate:
+                        self._ring = HashRing(self._destinations)
+                    self._unixsock = UnixSocket(collectd_socket) if collectd_socket else None
+                    self._spool = Spool(spool_file) if spool_file else None
+                    self._spool_only = spool_only
+                    self._max_pending_series = max_pending_series
+                    self._max_pending_bytes = max_pending_bytes
+                    self._reset_pending()
+                except:
+                    # __new__ has already registered us, so we must unregister
+                    # ourself or later calls would return this half-built object
+                    if Connection.instances.get(self._id) is self:
+                        del Connection.instances[self._id]
+                    raise
+                
+                # this is set last because it marks the object as initialized;
+                # a thread which got us from __new__ before an earlier attempt
+                # to initialize us failed registers us again once it succeeds
+                self._counters = {}
+                Connection.instances.setdefault(self._id, self)
+                if max_pending_series or max_pending_bytes:
+                    start_early_snapshots()
     
     @synchronized
     def __getattr__(self, name):
@@ -184,32 +713,112 @@ class Connection(object):
             raise AttributeError("{0} object has no attribute {1!r}".format(self.__class__.__name__, name))
         
         if name not in self._counters:
-            self._counters[name] = Counter(name)
+            limited = self._max_pending_series or self._max_pending_bytes
+            self._counters[name] = Counter(name, on_new_series = self._series_added if limited else None)
         return self._counters[name]
     
     @synchronized
-    def _snapshot(self):
-        return [c.snapshot() for c in self._counters.values() if c.counts]
+    def _series_added(self, count, size):
+        self._pending_series += count
+        self._pending_bytes += size
+        if (self._max_pending_series and self._pending_series > self._max_pending_series
+                or self._max_pending_bytes and self._pending_bytes > self._max_pending_bytes):
+            self._flush_requested = True
+            flush_requested.set()
+    
+    def _reset_pending(self):
+        self._pending_series = self._pending_bytes = 0
+        self._flush_requested = False
+    
+    def _snapshot(self, deadline = None):
+        with self._lock:
+            self._reset_pending()
+            counters = [c for c in self._counters.values()
+                        if c._slots or c._aggregate_slots or c.gauges]
+        
+        # every gauge of this connection runs concurrently within one time
+        # budget, so a slow gauge can't starve the gauges evaluated after it
+        if deadline is None:
+            deadline = time.time() + GAUGE_TIME_BUDGET
+        evaluations = [c._start_gauges() for c in counters]
+        return [c._finish_snapshot(e, deadline) for c, e in izip(counters, evaluations)]
+    
+    def _snapshot_new(self):
+        with self._lock:
+            self._reset_pending()
+            counters = self._counters.values()
+        return [c.snapshot_new() for c in counters]
+    
+    def _shards(self, stats):
+        if self._ring is None:
+            return [(stats, self._destinations)]
+        
+        shards = defaultdict(dict)
+        for name, value in stats.items():
+            shards[self._ring.get(name)][name] = value
+        return [(shard, [addr]) for addr, shard in shards.items()]
 
 
 
 snaps = Queue()
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+flush_requested = Event()
 
-def take_snapshots():
+def take_snapshots(early = False):
+    flush_requested.clear()
     for conn in Connection.instances.values():
-        snapshots = conn._snapshot()
-        if snapshots:
-            stats = {}
-            for snapshot in snapshots:
-                stats.update(snapshot)
+        if "_counters" not in conn.__dict__:
+            continue    # still being initialized by another thread
+        if not early:
+            snapshots = conn._snapshot()
+        elif conn._flush_requested:
+            snapshots = conn._snapshot_new()
+        else:
+            continue
+        
+        stats = {}
+        for snapshot in snapshots:
+            stats.update(snapshot)
+        if stats:
             snaps.put([int(time.time()), stats, conn])
 
+snapshot_lock = RLock()
+last_snapshot = 0
+
+def take_spaced_snapshots(early = False):
+    # collectd discards a value with the same timestamp as the previous value
+    # of that statistic and our timestamps only have a resolution of one
+    # second, so the snapshot threads never snapshot more often than that
+    global last_snapshot
+    with snapshot_lock:
+        time.sleep(max(0, last_snapshot + MIN_SNAPSHOT_INTERVAL - time.time()))
+        take_snapshots(early)
+        last_snapshot = time.time()
+
+def take_early_snapshots():
+    flush_requested.wait()
+    take_spaced_snapshots(early = True)
+
 def send_stats(raise_on_empty = False):
     try:
         when, stats, conn = snaps.get(timeout = 0.1)
-        for message in messages(stats, when, conn._hostname, conn._plugin_inst, conn._plugin_name):
-            sock.sendto(message, conn._collectd_addr)
+        args = (stats, when, conn._hostname, conn._plugin_inst, conn._plugin_name)
+        packets = None
+        if conn._spool:
+            packets = messages(*args)
+            conn._spool.append(packets)
+            if conn._spool_only:
+                return
+        
+        if conn._unixsock:
+            conn._unixsock.send(putvals(*args))
+        else:
+            for shard, addrs in conn._shards(stats):
+                if shard is not stats or packets is None:
+                    packets = messages(shard, *args[1:])
+                for message in packets:
+                    for addr in addrs:
+                        sock.sendto(message, addr)
     except Empty:
         if raise_on_empty:
             raise
@@ -234,5 +843,20 @@ def daemonize(func, sleep_for = 0):
 single_start = Semaphore()
 def start_threads():
     assert single_start.acquire(blocking = False)
-    daemonize(take_snapshots, sleep_for = SEND_INTERVAL)
+    threads_started.set()
+    daemonize(take_spaced_snapshots, sleep_for = SEND_INTERVAL)
     daemonize(send_stats)
+    for conn in Connection.instances.values():
+        if getattr(conn, "_max_pending_series", None) or getattr(conn, "_max_pending_bytes", None):
+            start_early_snapshots()
+
+# the thread for early snapshots is only started once a Connection has a
+# limit, so processes which don't use them never have it waiting around
+threads_started = Event()
+early_start = Semaphore()
+def start_early_snapshots():
+    if threads_started.is_set() and early_start.acquire(blocking = False):
+        daemonize(take_early_snapshots)
+
+if __name__ == "__main__":
+    replay_main()
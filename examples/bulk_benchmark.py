@@ -0,0 +1,43 @@
+import time
+import random
+
+import collectd
+
+ROWS = 1000000
+
+def looped(specifics, hits, latency):
+    counter = collectd.Counter("bench")
+    for specific, h, l in zip(specifics, hits, latency):
+        counter.record(specific, hits = h, latency = l)
+    return counter.snapshot()
+
+def bulk(specifics, hits, latency):
+    counter = collectd.Counter("bench")
+    counter.record_many(specifics, hits = hits, latency = latency)
+    return counter.snapshot()
+
+def timed(name, func, *args):
+    before = time.time()
+    result = func(*args)
+    elapsed = time.time() - before
+    print "{0:<24} {1:>8.3f}s {2:>10.3f} usec/row".format(name, elapsed, 1e6 * elapsed / ROWS)
+    return result
+
+if __name__ == "__main__":
+    random.seed(0)
+    specifics = [random.choice(["get", "put", "delete", "list"]) for i in xrange(ROWS)]
+    hits = [1] * ROWS
+    latency = [random.random() for i in xrange(ROWS)]
+
+    expected = timed("looped record()", looped, specifics, hits, latency)
+
+    timed("record_many() (lists)", bulk, specifics, hits, latency)
+
+    if collectd.numpy is not None:
+        numpy = collectd.numpy
+        arrays = [numpy.array(specifics), numpy.array(hits), numpy.array(latency)]
+        result = timed("record_many() (arrays)", bulk, *arrays)
+        for name, value in expected.items():
+            assert abs(result[name] - value) < 1e-6 * max(1, abs(value))
+    else:
+        print "numpy is not installed, skipping the numpy benchmarks"
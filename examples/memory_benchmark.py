@@ -0,0 +1,61 @@
+import gc
+import resource
+from collections import defaultdict
+from multiprocessing import Process, Queue
+
+import collectd
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SIZES = [10000, 100000, 1000000]
+
+# the nested dictionary layout used by Counter before version 1.1.0
+class DictCounter(object):
+    def __init__(self, category):
+        self.category = category
+        self.counts = defaultdict(lambda: defaultdict(float))
+
+    def record(self, *args, **kwargs):
+        for specific in list(args) + [""]:
+            for stat, value in kwargs.items():
+                self.counts[str(specific)][str(stat)] += value
+
+def populate(counter_class, series):
+    counter = counter_class("bench")
+    for i in xrange(series):
+        counter.record("specific{0}".format(i), hits = 1)
+    return counter
+
+# each measurement runs in a fresh process so that neither the allocator
+# nor a previous measurement can skew its peak memory usage
+def measure(counter_class, series, results):
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+        counter = populate(counter_class, series)
+        used = tracemalloc.get_traced_memory()[0]
+    else:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        counter = populate(counter_class, series)
+        used = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+    results.put(used)
+
+def measure_in_child(counter_class, series):
+    results = Queue()
+    child = Process(target = measure, args = (counter_class, series, results))
+    child.start()
+    used = results.get()
+    child.join()
+    return used
+
+if __name__ == "__main__":
+    print "measuring with", "tracemalloc" if tracemalloc else "peak RSS"
+    print "{0:>10} {1:>14} {2:>14} {3:>14}".format("series", "dict (MB)", "array (MB)", "bytes/series")
+    for series in SIZES:
+        old = measure_in_child(DictCounter, series)
+        new = measure_in_child(collectd.Counter, series)
+        print "{0:>10} {1:>14.1f} {2:>14.1f} {3:>7.0f} -> {4:.0f}".format(
+            series, old / 1e6, new / 1e6, float(old) / series, float(new) / series)
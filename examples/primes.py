@@ -7,6 +7,7 @@ import collectd
 
 numbers = Queue()
 conn = collectd.Connection()
+conn.queue.gauge("size", numbers.qsize)
 
 def is_prime(n):
     for i in xrange(2, n):
@@ -14,11 +15,6 @@ def is_prime(n):
             return False
     return True
 
-def watch_queue():
-    while True:
-        conn.queue.set_exact(size = numbers.qsize())
-        time.sleep(1)
-
 def consumer():
     while True:
         n = numbers.get()
@@ -46,9 +42,8 @@ def producer():
 
 if __name__ == "__main__":
     collectd.start_threads()
-    for func in [producer, consumer]:
-        t = Thread(target = func)
-        t.daemon = True
-        t.start()
+    t = Thread(target = producer)
+    t.daemon = True
+    t.start()
     
-    watch_queue()
+    consumer()
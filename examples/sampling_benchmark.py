@@ -0,0 +1,26 @@
+import time
+import random
+
+import collectd
+
+CALLS = 500000
+RATES = [1.0, 0.5, 0.1, 0.01, 0.001]
+
+def run(rate):
+    counter = collectd.Counter("bench", sample_rate = rate)
+    before = time.time()
+    for i in xrange(CALLS):
+        counter.record("sub", hits = 1)
+    elapsed = time.time() - before
+    recorded = counter.snapshot()["bench-hits"]
+    return elapsed, abs(recorded - CALLS) / CALLS
+
+if __name__ == "__main__":
+    random.seed(0)
+    print "{0:>8} {1:>12} {2:>12} {3:>10}".format("rate", "usec/call", "speedup", "error")
+    baseline = None
+    for rate in RATES:
+        elapsed, error = run(rate)
+        baseline = baseline or elapsed
+        print "{0:>8} {1:>12.3f} {2:>11.1f}x {3:>9.2%}".format(
+            rate, 1e6 * elapsed / CALLS, baseline / elapsed, error)
@@ -2,8 +2,11 @@ from setuptools import setup
 
 setup(
     name = "collectd",
-    version = "1.0.2",
+    version = "1.1.0",
     py_modules = ["collectd"],
+    entry_points = {
+        "console_scripts": ["collectd-replay = collectd:replay_main"],
+    },
     
     author = "Eli Courtwright",
     author_email = "eli@courtwright.org",
@@ -11,7 +14,7 @@ setup(
     license = "BSD",
     url = "https://github.com/appliedsec/collectd",
     
-    download_url = "https://github.com/downloads/appliedsec/collectd/collectd-1.0.2.tar.gz",
+    download_url = "https://github.com/downloads/appliedsec/collectd/collectd-1.1.0.tar.gz",
     
     classifiers = [
         "Programming Language :: Python",
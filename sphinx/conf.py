@@ -45,9 +45,9 @@ copyright = u'2012, Eli Courtwright'
 # built documents.
 #
 # The short X.Y version.
-version = '1.0.2'
+version = '1.1.0'
 # The full version, including alpha/beta/rc tags.
-release = '1.0.2'
+release = '1.1.0'
 
 # The language for content autogenerated by Sphinx. Refer to documentation
 # for a list of supported languages.
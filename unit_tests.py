@@ -1,7 +1,17 @@
+import os
+import sys
 import time
+import shutil
 import struct
 import socket
+import random
 import logging
+import resource
+import tempfile
+import multiprocessing
+from Queue import Queue
+from StringIO import StringIO
+from threading import Thread, Event
 from random import randrange
 from unittest import TestCase, main
 
@@ -49,8 +59,8 @@ class CounterTests(BaseCase):
     def setUp(self):
         self.counter = collectd.Counter("test")
     
-    def snapshot(self):
-        return self.counter.snapshot()
+    def snapshot(self, deadline = None):
+        return self.counter.snapshot(deadline)
     
     def record(self, *args, **kwargs):
         self.counter.record(*args, **kwargs)
@@ -58,6 +68,30 @@ class CounterTests(BaseCase):
     def set_exact(self, **kwargs):
         self.counter.set_exact(**kwargs)
     
+    def record_sampled(self, rate, *args, **kwargs):
+        self.counter.record_sampled(rate, *args, **kwargs)
+    
+    def set_sample_rate(self, rate):
+        self.counter.sample_rate = rate
+    
+    def gauge(self, stat, func):
+        self.counter.gauge(stat, func)
+    
+    def set_aggregate(self, **kwargs):
+        self.counter.set_aggregate(**kwargs)
+    
+    def record_many(self, specifics, **columns):
+        specifics, columns = self.as_arrays(specifics, columns)
+        self.counter.record_many(specifics, **columns)
+    
+    def as_arrays(self, specifics, columns):
+        if getattr(self, "use_arrays", False):
+            columns = dict((stat, collectd.numpy.array(col))
+                           for stat, col in columns.items())
+            if specifics is not None:
+                specifics = collectd.numpy.array(specifics)
+        return specifics, columns
+    
     def test_snapshot_reset(self):
         self.assertEqual({}, self.snapshot())
         self.record(foo = 2)
@@ -129,6 +163,195 @@ class CounterTests(BaseCase):
         for func in [self.record, self.set_exact]:
             func(**stats)
             self.assertEqual({"test-foo_bar": 5}, self.snapshot())
+    
+    def test_sampled_full_rate(self):
+        for rate in [1, 1.0, 5]:
+            self.record_sampled(rate, "sub", foo = 2)
+            self.assertEqual({"test-foo": 2, "test-sub-foo": 2}, self.snapshot())
+    
+    def test_sampled_zero_rate(self):
+        self.record_sampled(0, foo = 2)
+        self.set_sample_rate(0)
+        self.record(foo = 2)
+        self.assertEqual({}, self.snapshot())
+    
+    def test_sampled_scaling(self):
+        random.seed(1337)
+        for rate in [0.5, 0.1, 0.01]:
+            for i in range(20000):
+                self.record_sampled(rate, "sub", foo = 1)
+            snap = self.snapshot()
+            self.assertEqual(snap["test-foo"], snap["test-sub-foo"])
+            self.assertAlmostEqual(1.0, snap["test-foo"] / 20000, delta = 0.15)
+    
+    def test_sample_rate(self):
+        random.seed(1337)
+        self.set_sample_rate(0.1)
+        for i in range(20000):
+            self.record(foo = 2)
+        self.assertAlmostEqual(1.0, self.snapshot()["test-foo"] / 40000, delta = 0.1)
+    
+    def test_sampled_bad_stats(self):
+        for rate in [0.999999, None, "invalid"]:
+            self.record_sampled(rate, foo = "invalid")
+            self.record_sampled(rate, None, foo = 2)
+            self.assertEqual({}, self.snapshot())
+    
+    def test_bad_sample_rates(self):
+        for rate in [None, "invalid", "0.5", [], 2 ** 100]:
+            self.record_sampled(rate, "sub", foo = 2)
+            self.set_sample_rate(rate)
+            self.record("sub", foo = 2)
+            self.assertEqual({}, self.snapshot())
+    
+    def test_gauge(self):
+        calls = []
+        def size():
+            calls.append(1)
+            return len(calls) * 10
+        
+        self.gauge("size", size)
+        self.assertEqual([], calls)
+        self.assertEqual({"test-size": 10}, self.snapshot())
+        self.assertEqual({"test-size": 20}, self.snapshot())
+        self.assertEqual(2, len(calls))
+    
+    def test_gauge_with_counts(self):
+        self.gauge("size", lambda: 3)
+        self.record("sub", foo = 2)
+        self.assertEqual({"test-size": 3, "test-foo": 2, "test-sub-foo": 2},
+                         self.snapshot())
+    
+    def test_gauge_replaced(self):
+        self.gauge("size", lambda: 3)
+        self.gauge("size", lambda: 4)
+        self.assertEqual({"test-size": 4}, self.snapshot())
+    
+    def test_gauge_errors(self):
+        self.gauge("good", lambda: 5)
+        self.gauge("raises", lambda: 1 // 0)
+        self.gauge("invalid", lambda: "invalid")
+        self.gauge("uncallable", 5)
+        self.assertEqual({"test-good": 5}, self.snapshot())
+    
+    def test_gauge_time_budget(self):
+        def slow():
+            time.sleep(0.2)
+            return 1
+        
+        self.gauge("slow1", slow)
+        self.gauge("slow2", slow)
+        self.gauge("fast", lambda: 2)
+        self.assertEqual({"test-fast": 2}, self.snapshot(time.time() + 0.05))
+        time.sleep(0.2)
+        self.assertEqual(3, len(self.snapshot(time.time() + 0.5)))
+    
+    def test_gauge_hung(self):
+        release = Event()
+        def hung():
+            release.wait()
+            return 1
+        
+        self.gauge("hung", hung)
+        self.gauge("fast", lambda: 2)
+        for i in range(3):
+            before = time.time()
+            self.assertEqual({"test-fast": 2}, self.snapshot(time.time() + 0.1))
+            self.assertTrue(time.time() - before < 0.5)
+        
+        release.set()
+        time.sleep(0.1)
+        self.assertEqual({"test-fast": 2, "test-hung": 1}, self.snapshot())
+    
+    def test_aggregate(self):
+        for value in [3, 1, 4, 1, 5, 9, 2, 6]:
+            self.set_aggregate(depth = value)
+        self.assertEqual({"test-depth-min": 1, "test-depth-max": 9,
+                          "test-depth-avg": 3.875}, self.snapshot())
+        self.assertEqual({}, self.snapshot())
+    
+    def test_aggregate_single(self):
+        self.set_aggregate(depth = -2.5, size = 7)
+        self.assertEqual({"test-depth-min": -2.5, "test-depth-max": -2.5,
+                          "test-depth-avg": -2.5, "test-size-min": 7,
+                          "test-size-max": 7, "test-size-avg": 7},
+                         self.snapshot())
+    
+    def test_aggregate_with_counts(self):
+        self.set_aggregate(depth = 2)
+        self.set_exact(foo = 3)
+        self.assertEqual({"test-depth-min": 2, "test-depth-max": 2,
+                          "test-depth-avg": 2, "test-foo": 3}, self.snapshot())
+    
+    def test_aggregate_bad_stats(self):
+        self.set_aggregate()
+        for val in ["invalid", 2 ** 100, None]:
+            self.set_aggregate(depth = val)
+        self.assertEqual({}, self.snapshot())
+    
+    def test_aggregate_sanitize(self):
+        self.set_aggregate(**{"#depth!": 1})
+        self.assertEqual({"test-depth-min": 1, "test-depth-max": 1,
+                          "test-depth-avg": 1}, self.snapshot())
+    
+    def with_and_without_numpy(self, func):
+        func()
+        if collectd.numpy is not None:
+            self.use_arrays = True
+            try:
+                func()
+            finally:
+                self.use_arrays = False
+    
+    def test_record_many_matches_record(self):
+        specifics = [random.choice(["a", "b", "c", u"d"]) for i in range(1000)]
+        hits = [randrange(10) for i in range(1000)]
+        time = [random.random() for i in range(1000)]
+        for specific, h, t in zip(specifics, hits, time):
+            self.record(specific, hits = h, time = t)
+        expected = self.snapshot()
+        
+        def check():
+            self.record_many(specifics, hits = hits, time = time)
+            snap = self.snapshot()
+            self.assertEqual(sorted(expected), sorted(snap))
+            for name in expected:
+                self.assertAlmostEqual(expected[name], snap[name])
+        self.with_and_without_numpy(check)
+    
+    def test_record_many_no_specifics(self):
+        def check():
+            self.record_many(None, foo = [1, 2, 3], bar = [0.5, 0.5, 0.5])
+            self.assertEqual({"test-foo": 6, "test-bar": 1.5}, self.snapshot())
+        self.with_and_without_numpy(check)
+    
+    def test_record_many_adding(self):
+        def check():
+            self.record("a", foo = 1)
+            self.record_many(["a", "b"], foo = [2, 3])
+            self.assertEqual({"test-foo": 6, "test-a-foo": 3, "test-b-foo": 3},
+                             self.snapshot())
+        self.with_and_without_numpy(check)
+    
+    def test_record_many_empty(self):
+        def check():
+            self.record_many([], foo = [])
+            self.record_many(None)
+            self.record_many(["a"])
+            self.assertEqual({}, self.snapshot())
+        self.with_and_without_numpy(check)
+    
+    def test_record_many_bad_stats(self):
+        def check():
+            self.record_many(["a", "b"], foo = [1])
+            self.record_many(["a"], foo = [1], bar = [1, 2])
+            self.record_many(["a", None], foo = [1, 2])
+            self.record_many([5, 6], foo = [1, 2])
+            self.record_many(["a", "b"], foo = [1, "invalid"])
+            self.record_many(["a", "b"], foo = [1, 2], bar = ["x", "y"])
+            self.record_many(["a"], foo = 5)
+            self.assertEqual({}, self.snapshot())
+        self.with_and_without_numpy(check)
 
 
 class ConnectionTests(CounterTests):
@@ -138,8 +361,8 @@ class ConnectionTests(CounterTests):
     def tearDown(self):
         collectd.Connection.instances.clear()
     
-    def snapshot(self):
-        snap = self.conn._snapshot()
+    def snapshot(self, deadline = None):
+        snap = self.conn._snapshot(deadline)
         return snap[0] if snap else {}
     
     def record(self, *args, **kwargs):
@@ -148,6 +371,22 @@ class ConnectionTests(CounterTests):
     def set_exact(self, **kwargs):
         self.conn.test.set_exact(**kwargs)
     
+    def record_sampled(self, rate, *args, **kwargs):
+        self.conn.test.record_sampled(rate, *args, **kwargs)
+    
+    def set_sample_rate(self, rate):
+        self.conn.test.sample_rate = rate
+    
+    def gauge(self, stat, func):
+        self.conn.test.gauge(stat, func)
+    
+    def set_aggregate(self, **kwargs):
+        self.conn.test.set_aggregate(**kwargs)
+    
+    def record_many(self, specifics, **columns):
+        specifics, columns = self.as_arrays(specifics, columns)
+        self.conn.test.record_many(specifics, **columns)
+    
     def test_sameness(self):
         for params in [{"hostname":"127.0.0.1"}, {"collectd_port":1337}]:
             self.assertTrue(self.conn is not collectd.Connection(**params))
@@ -203,6 +442,20 @@ class PacketTests(BaseCase):
     def test_oversize_messages(self):
         self.assertValidMessages(0, {"X"*collectd.MAX_PACKET_SIZE: 1})
         self.assertValidMessages(1, {"X"*collectd.MAX_PACKET_SIZE: 1, "Y": 2})
+    
+    def test_putval(self):
+        self.assertEqual('PUTVAL "host/any/gauge-test-foo" interval=10 1234:5.0\n',
+                         collectd.putval("test-foo", 5, 1234.5, "host", "", "any"))
+        self.assertEqual('PUTVAL "host/dckx-xkcd/gauge-foo" interval=10 1234:-0.5\n',
+                         collectd.putval("foo", -0.5, 1234, "host", "xkcd", "dckx"))
+        self.assertEqual('PUTVAL "my \\"host\\"/any/gauge-foo" interval=10 1:1.0\n',
+                         collectd.putval("foo", 1, 1, 'my "host"', "", "any"))
+    
+    def test_putvals(self):
+        self.assertEqual([], collectd.putvals({}))
+        lines = collectd.putvals({"foo": 1, "bar": 2}, 1234)
+        self.assertEqual(2, len(lines))
+        self.assertTrue(all(line.startswith("PUTVAL ") for line in lines))
 
 
 class SnapshotTests(BaseCase):
@@ -240,6 +493,33 @@ class SnapshotTests(BaseCase):
         collectd.take_snapshots()
         self.assertQueued(1)
     
+    def test_gauges(self):
+        conn = collectd.Connection()
+        conn.queue.gauge("size", lambda: 5)
+        collectd.take_snapshots()
+        collectd.take_snapshots()
+        self.assertQueued(2)
+    
+    def test_gauge_budget_per_connection(self):
+        release = Event()
+        def slow():
+            time.sleep(0.05)
+            return 1
+        
+        for port in range(1, 11):
+            conn = collectd.Connection(collectd_port = port)
+            conn.queue.gauge("hung", release.wait)
+            conn.queue.gauge("slow", slow)
+        
+        budget = collectd.GAUGE_TIME_BUDGET
+        collectd.GAUGE_TIME_BUDGET = 0.1
+        try:
+            collectd.take_snapshots()
+        finally:
+            collectd.GAUGE_TIME_BUDGET = budget
+            release.set()
+        self.assertQueued(10)
+    
     def test_multiple_conns(self):
         conn1 = collectd.Connection(collectd_host = "localhost")
         conn2 = collectd.Connection(collectd_host = "127.0.0.1")
@@ -303,9 +583,9 @@ class SocketTests(BaseCase):
         self.conn.test.record(**dict(stats))
         collectd.take_snapshots()
         collectd.send_stats(raise_on_empty = True)
+        packets = [self.server.recv(collectd.MAX_PACKET_SIZE) for i in range(2)]
         for name,val in stats:
-            packet = self.server.recv(collectd.MAX_PACKET_SIZE)
-            self.assertTrue(name + "\0" in packet)
+            [packet] = [p for p in packets if name + "\0" in p]
             self.assertTrue(struct.pack("<d", val) in packet)
             self.assertValidPacket(8, packet)
     
@@ -325,6 +605,563 @@ class SocketTests(BaseCase):
             self.assertTrue(struct.pack("<d", val) in data)
 
 
+class UnixSockServer(Thread):
+    def __init__(self, path, response = "0 Success: 1 value has been dispatched."):
+        Thread.__init__(self)
+        self.daemon = True
+        self.response = response
+        self.lines = Queue()
+        self.conn, self.connections = None, 0
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(5)
+        self.start()
+    
+    def run(self):
+        while True:
+            try:
+                self.conn, addr = self.listener.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            try:
+                f = self.conn.makefile()
+                for line in iter(f.readline, ""):
+                    self.lines.put(line)
+                    if self.response is not None:
+                        self.conn.sendall(self.response + "\n")
+            except socket.error:
+                pass
+    
+    def drop(self):
+        self.conn.shutdown(socket.SHUT_RDWR)
+        self.conn.close()
+    
+    def stop(self):
+        self.listener.shutdown(socket.SHUT_RDWR)
+        self.listener.close()
+        if self.conn:
+            self.drop()
+    
+    def received(self, count):
+        return [self.lines.get(timeout = 1) for i in range(count)]
+
+
+class UnixSocketTests(BaseCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "unixsock")
+        self.server = UnixSockServer(self.path)
+        self.conn = collectd.Connection(collectd_socket = self.path)
+    
+    def tearDown(self):
+        for conn in collectd.Connection.instances.values():
+            if conn._unixsock:
+                conn._unixsock.close()
+        collectd.Connection.instances.clear()
+        self.server.stop()
+        shutil.rmtree(self.tempdir)
+    
+    def send(self, **stats):
+        self.conn.test.record(**stats)
+        collectd.take_snapshots()
+        collectd.send_stats(raise_on_empty = True)
+    
+    def test_sameness(self):
+        self.assertTrue(self.conn is not collectd.Connection())
+        self.assertTrue(self.conn is collectd.Connection(collectd_socket = self.path))
+    
+    def test_single(self):
+        self.send(foo = 5)
+        [line] = self.server.received(1)
+        self.assertTrue(line.startswith('PUTVAL "{0}/any/gauge-test-foo" interval=10 '
+                                        .format(socket.gethostname())))
+        self.assertTrue(line.endswith(":5.0\n"))
+    
+    def test_batches(self):
+        count = 2 * collectd.PUTVAL_BATCH_SIZE + 1
+        self.send(**dict(("x{0}".format(i), i) for i in range(count)))
+        lines = self.server.received(count)
+        self.assertEqual(count, len(set(lines)))
+        self.assertTrue(self.server.lines.empty())
+        self.assertEqual(1, self.server.connections)
+    
+    def test_persistent(self):
+        for i in range(3):
+            self.send(foo = i)
+            self.server.received(1)
+        self.assertEqual(1, self.server.connections)
+    
+    def test_reconnect(self):
+        self.send(foo = 1)
+        self.server.received(1)
+        self.server.drop()
+        self.send(foo = 2)
+        self.assertTrue(self.server.received(1)[-1].endswith(":2.0\n"))
+        self.assertEqual(2, self.server.connections)
+    
+    def test_rejected(self):
+        self.server.response = "-1 Failed: value too old"
+        self.send(foo = 1, bar = 2)
+        self.server.received(2)
+    
+    def test_no_response(self):
+        self.server.response = None
+        timeout = collectd.UNIXSOCK_TIMEOUT
+        collectd.UNIXSOCK_TIMEOUT = 0.2
+        try:
+            self.send(foo = 1, bar = 2)
+        finally:
+            collectd.UNIXSOCK_TIMEOUT = timeout
+        self.server.received(2)
+        time.sleep(0.2)
+        self.assertTrue(self.server.lines.empty())
+        self.assertEqual(1, self.server.connections)
+    
+    def test_server_down(self):
+        os.remove(self.path)
+        self.assertRaises(socket.error, self.send, foo = 1)
+
+
+class SpoolTests(BaseCase):
+    TEST_PORT = 13368
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "spool")
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("localhost", self.TEST_PORT))
+        self.server.settimeout(0.1)
+    
+    def tearDown(self):
+        for conn in collectd.Connection.instances.values():
+            if conn._spool:
+                conn._spool.close()
+        collectd.Connection.instances.clear()
+        self.server.close()
+        shutil.rmtree(self.tempdir)
+    
+    def send(self, conn, **stats):
+        conn.test.record(**stats)
+        collectd.take_snapshots()
+        collectd.send_stats(raise_on_empty = True)
+    
+    def spooled(self):
+        packets = list(collectd.read_spool(self.path))
+        for packet in packets:
+            self.assertValidPacket(8, packet)
+        return packets
+    
+    def test_empty(self):
+        collectd.Spool(self.path).close()
+        self.assertEqual([], self.spooled())
+    
+    def test_spool_and_send(self):
+        conn = collectd.Connection(collectd_port = self.TEST_PORT, spool_file = self.path)
+        self.send(conn, foo = 5)
+        self.send(conn, bar = 6)
+        self.assertEqual([self.server.recv(collectd.MAX_PACKET_SIZE) for i in range(2)],
+                         self.spooled())
+    
+    def test_spool_only(self):
+        conn = collectd.Connection(collectd_port = self.TEST_PORT,
+                                   spool_file = self.path, spool_only = True)
+        self.send(conn, foo = 5)
+        self.assertEqual(1, len(self.spooled()))
+        self.assertRaises(socket.timeout, self.server.recv, collectd.MAX_PACKET_SIZE)
+    
+    def test_many_packets(self):
+        conn = collectd.Connection(spool_file = self.path, spool_only = True)
+        self.send(conn, **dict(("x{0:02}".format(i), i) for i in range(50)))
+        self.assertEqual(2, len(self.spooled()))
+    
+    def test_reopen(self):
+        for i in range(3):
+            spool = collectd.Spool(self.path)
+            spool.append(collectd.messages({"foo": i}))
+            spool.close()
+        self.assertEqual(3, len(self.spooled()))
+    
+    def test_truncated(self):
+        spool = collectd.Spool(self.path)
+        spool.append(collectd.messages({"foo": 1}) * 2)
+        spool.close()
+        with open(self.path, "ab") as f:
+            f.write(collectd.SPOOL_HEADER.pack(100) + "partial")
+        self.assertEqual(2, len(self.spooled()))
+        
+        spool = collectd.Spool(self.path)
+        spool.append(collectd.messages({"bar": 2}))
+        spool.close()
+        packets = self.spooled()
+        self.assertEqual(3, len(packets))
+        self.assertTrue("bar\0" in packets[-1])
+    
+    def test_batched_sync(self):
+        synced = []
+        real_fsync = collectd.os.fsync
+        collectd.os.fsync = synced.append
+        try:
+            spool = collectd.Spool(self.path)
+            for i in range(100):
+                spool.append(collectd.messages({"foo": i}))
+            self.assertEqual([], synced)
+            spool._last_sync -= collectd.SPOOL_SYNC_INTERVAL
+            spool.append(collectd.messages({"foo": 0}))
+            self.assertEqual(1, len(synced))
+            spool.close()
+            self.assertEqual(2, len(synced))
+        finally:
+            collectd.os.fsync = real_fsync
+        self.assertEqual(101, len(self.spooled()))
+    
+    def test_unopenable(self):
+        path = os.path.join(self.tempdir, "missing", "spool")
+        for i in range(2):
+            self.assertRaises(IOError, collectd.Connection, spool_file = path)
+        self.assertEqual({}, collectd.Connection.instances)
+        
+        conn = collectd.Connection(collectd_port = self.TEST_PORT)
+        self.send(conn, foo = 5)
+        self.server.recv(collectd.MAX_PACKET_SIZE)
+    
+    def test_concurrent_init(self):
+        opened = []
+        real_spool = collectd.Spool
+        def slow_spool(path):
+            opened.append(path)
+            time.sleep(0.1)
+            return real_spool(path)
+        
+        conns = []
+        collectd.Spool = slow_spool
+        try:
+            threads = [Thread(target = lambda: conns.append(collectd.Connection(spool_file = self.path)))
+                       for i in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            collectd.Spool = real_spool
+        self.assertEqual([self.path], opened)
+        self.assertTrue(conns[0] is conns[1])
+        self.assertTrue(conns[0]._spool is not None)
+    
+    def test_replay(self):
+        spool = collectd.Spool(self.path)
+        spool.append(collectd.messages(dict(("x{0:02}".format(i), i) for i in range(50))))
+        spool.close()
+        self.assertEqual(2, collectd.replay(self.path, "localhost", self.TEST_PORT))
+        self.assertEqual(self.spooled(),
+                         [self.server.recv(collectd.MAX_PACKET_SIZE) for i in range(2)])
+    
+    def test_replay_rate(self):
+        spool = collectd.Spool(self.path)
+        spool.append(collectd.messages({"foo": 1}) * 11)
+        spool.close()
+        before = time.time()
+        self.assertEqual(11, collectd.replay(self.path, "localhost", self.TEST_PORT, rate = 50))
+        self.assertTrue(time.time() - before >= 0.2)
+        for i in range(11):
+            self.server.recv(collectd.MAX_PACKET_SIZE)
+    
+    def test_replay_main(self):
+        spool = collectd.Spool(self.path)
+        spool.append(collectd.messages({"foo": 1}))
+        spool.close()
+        sys.stdout = StringIO()
+        try:
+            collectd.replay_main(["--port", str(self.TEST_PORT), "--rate", "0", self.path])
+            self.assertTrue("sent 1 packets" in sys.stdout.getvalue())
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(self.spooled(), [self.server.recv(collectd.MAX_PACKET_SIZE)])
+
+class ShardingTests(BaseCase):
+    TEST_PORTS = [13370, 13371, 13372]
+    
+    def setUp(self):
+        self.destinations = [("localhost", port) for port in self.TEST_PORTS]
+        self.servers = []
+        for port in self.TEST_PORTS:
+            server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 ** 20)
+            server.bind(("localhost", port))
+            server.settimeout(0.1)
+            self.servers.append(server)
+    
+    def tearDown(self):
+        collectd.Connection.instances.clear()
+        for server in self.servers:
+            server.close()
+    
+    def send(self, conn, count):
+        conn.test.record(**dict(("x{0}".format(i), i) for i in range(count)))
+        collectd.take_snapshots()
+        collectd.send_stats(raise_on_empty = True)
+    
+    def received(self, server):
+        packets = []
+        try:
+            while True:
+                packets.append(server.recv(collectd.MAX_PACKET_SIZE))
+        except socket.timeout:
+            pass
+        for packet in packets:
+            self.assertValidPacket(8, packet)
+        values = struct.pack("!HHH", collectd.TYPE_VALUES, 15, 1)
+        return sum(packet.count(values) for packet in packets)
+    
+    def test_sameness(self):
+        conn = collectd.Connection(destinations = self.destinations)
+        self.assertTrue(conn is collectd.Connection(destinations = tuple(self.destinations)))
+        self.assertTrue(conn is not collectd.Connection())
+        self.assertTrue(conn is not collectd.Connection(destinations = self.destinations,
+                                                        replicate = True))
+    
+    def test_single_destination(self):
+        conn = collectd.Connection(destinations = self.destinations[:1])
+        self.send(conn, 50)
+        self.assertEqual([50, 0, 0], [self.received(s) for s in self.servers])
+    
+    def test_sharded(self):
+        conn = collectd.Connection(destinations = self.destinations)
+        self.send(conn, 900)
+        counts = [self.received(s) for s in self.servers]
+        self.assertEqual(900, sum(counts))
+        for count in counts:
+            self.assertTrue(255 <= count <= 345, counts)
+    
+    def test_sharding_is_stable(self):
+        conn = collectd.Connection(destinations = self.destinations)
+        self.send(conn, 100)
+        first = [self.received(s) for s in self.servers]
+        self.send(conn, 100)
+        self.assertEqual(first, [self.received(s) for s in self.servers])
+    
+    def test_replicated(self):
+        conn = collectd.Connection(destinations = self.destinations, replicate = True)
+        self.send(conn, 100)
+        self.assertEqual([100, 100, 100], [self.received(s) for s in self.servers])
+    
+    def test_hash_ring_membership(self):
+        names = ["test-x{0}".format(i) for i in range(1000)]
+        before = collectd.HashRing(self.destinations)
+        after = collectd.HashRing(self.destinations[:2])
+        moved = 0
+        for name in names:
+            if before.get(name) == self.destinations[2]:
+                moved += 1
+            else:
+                self.assertEqual(before.get(name), after.get(name))
+        self.assertTrue(0 < moved < 500)
+
+class EarlyFlushTests(BaseCase):
+    def tearDown(self):
+        collectd.Connection.instances.clear()
+        collectd.flush_requested.clear()
+        while collectd.snaps.qsize():
+            collectd.snaps.get()
+    
+    def queued(self):
+        stats = []
+        while collectd.snaps.qsize():
+            stats.append(collectd.snaps.get()[1])
+        return stats
+    
+    def test_new_series_callback(self):
+        added = []
+        counter = collectd.Counter("test", on_new_series = lambda *args: added.append(args))
+        counter.record("sub", foo = 1)
+        self.assertEqual([(1, len(collectd.pack("test-sub-foo", 0))),
+                          (1, len(collectd.pack("test-foo", 0)) + 1)], added)
+        counter.record("sub", foo = 1)
+        counter.set_exact(foo = 2)
+        self.assertEqual(2, len(added))
+        counter.set_aggregate(depth = 1)
+        self.assertEqual(3, added[-1][0])
+    
+    def tracked(self):
+        return collectd.Counter("test", on_new_series = lambda count, size: None)
+    
+    def test_untracked(self):
+        counter = collectd.Counter("test")
+        counter.record("a", foo = 1)
+        counter.set_aggregate(depth = 1)
+        self.assertEqual([], counter._new_slots)
+        self.assertEqual([], counter._new_aggregate_slots)
+        self.assertEqual({}, counter.snapshot_new())
+        
+        conn = collectd.Connection()
+        self.assertTrue(conn.test._on_new_series is None)
+        self.assertTrue(collectd.Connection(max_pending_series = 5).test._on_new_series)
+    
+    def test_snapshot_new(self):
+        counter = self.tracked()
+        counter.record("steady", foo = 1)
+        self.assertEqual({"test-foo": 1, "test-steady-foo": 1}, counter.snapshot())
+        
+        counter.record("a", foo = 1)
+        counter.set_aggregate(depth = 3)
+        self.assertEqual({"test-a-foo": 1, "test-depth-min": 3,
+                          "test-depth-max": 3, "test-depth-avg": 3}, counter.snapshot_new())
+        self.assertEqual({}, counter.snapshot_new())
+        self.assertEqual({"test-foo": 1}, counter.snapshot())
+        self.assertTrue(("a", "foo") in counter._slots)
+        self.assertTrue("depth" in counter._aggregate_slots)
+        
+        counter.record("a", foo = 2)
+        counter.record("b", foo = 3)
+        self.assertEqual({"test-b-foo": 3}, counter.snapshot_new())
+        self.assertEqual({"test-foo": 5, "test-a-foo": 2}, counter.snapshot())
+    
+    def test_recorded_zero(self):
+        counter = self.tracked()
+        counter.record("a", foo = 1)
+        counter.snapshot()
+        counter.record("a", foo = 0)
+        counter.set_exact(bar = 0)
+        counter.snapshot_new()
+        counter.set_exact(bar = 0)
+        self.assertEqual({"test-foo": 0, "test-a-foo": 0, "test-bar": 0}, counter.snapshot())
+    
+    def test_idle_forgotten(self):
+        counter = self.tracked()
+        counter.record("a", foo = 1)
+        counter.set_aggregate(depth = 1)
+        self.assertEqual(5, len(counter.snapshot()))
+        self.assertEqual({}, counter.snapshot())
+        self.assertEqual({}, counter._slots)
+        self.assertEqual({}, counter._aggregate_slots)
+        
+        counter.record("a", foo = 2)
+        self.assertEqual({"test-foo": 2, "test-a-foo": 2}, counter.snapshot_new())
+    
+    def test_idle_slots_reused(self):
+        counter = self.tracked()
+        for burst in range(10):
+            counter.record(**dict(("x{0}_{1}".format(burst, i), 1) for i in range(100)))
+            counter.set_aggregate(**dict(("y{0}_{1}".format(burst, i), 1) for i in range(100)))
+            self.assertEqual(400, len(counter.snapshot_new()))
+            self.assertEqual({}, counter.snapshot())
+        self.assertEqual(200, len(counter._values))
+        self.assertEqual(800, len(counter._aggregates))
+    
+    def test_steady_above_limit(self):
+        conn = collectd.Connection(max_pending_series = 5)
+        early = 0
+        for interval in range(3):
+            for second in range(10):
+                for i in range(10):
+                    conn.test.record("e{0}".format(i), hits = 1)
+                    if collectd.flush_requested.is_set():
+                        collectd.take_snapshots(early = True)
+                        early += 1
+            self.queued()
+            collectd.take_snapshots()
+            [stats] = self.queued()
+            self.assertEqual(11, len(stats))
+        
+        self.assertEqual(1, early)
+        self.assertEqual(100, stats["test-hits"])
+        self.assertEqual(10, stats["test-e0-hits"])
+        self.assertEqual(11, len(conn.test._slots))
+    
+    def test_max_pending_series(self):
+        conn = collectd.Connection(max_pending_series = 10)
+        conn.test.record(**dict(("x{0}".format(i), 1) for i in range(10)))
+        collectd.take_snapshots()
+        self.queued()
+        
+        conn.test.record(**dict(("y{0}".format(i), 1) for i in range(10)))
+        conn.test.record(x0 = 1, y0 = 1)
+        self.assertFalse(collectd.flush_requested.is_set())
+        conn.test.record(y10 = 1)
+        self.assertTrue(collectd.flush_requested.is_set())
+        self.assertTrue(conn._flush_requested)
+        
+        collectd.take_snapshots(early = True)
+        self.assertFalse(collectd.flush_requested.is_set())
+        self.assertFalse(conn._flush_requested)
+        [stats] = self.queued()
+        self.assertEqual(sorted("test-y{0}".format(i) for i in range(11)), sorted(stats))
+        self.assertEqual(2, stats["test-y0"])
+    
+    def test_max_pending_bytes(self):
+        conn = collectd.Connection(max_pending_bytes = 100)
+        conn.test.record(a = 1, b = 1, c = 1)
+        self.assertFalse(collectd.flush_requested.is_set())
+        conn.test.record(d = 1)
+        self.assertTrue(collectd.flush_requested.is_set())
+    
+    def test_regular_snapshot_resets(self):
+        conn = collectd.Connection(max_pending_series = 2)
+        conn.test.record(a = 1, b = 1, c = 1)
+        collectd.take_snapshots()
+        self.assertFalse(conn._flush_requested)
+        self.assertEqual(0, conn._pending_series)
+        self.assertEqual(1, len(self.queued()))
+    
+    def test_early_only_flagged(self):
+        unlimited = collectd.Connection()
+        limited = collectd.Connection(max_pending_series = 2)
+        unlimited.test.record(a = 1, b = 1, c = 1)
+        limited.test.record(a = 1, b = 1, c = 1)
+        collectd.take_snapshots(early = True)
+        [(when, stats, conn)] = [collectd.snaps.get()]
+        self.assertTrue(conn is limited)
+        self.assertEqual(0, collectd.snaps.qsize())
+    
+    def burst(self, limits, results):
+        # every interval brings 2000 brand new series which are never seen
+        # again, arriving in bursts of 500 between two regular snapshots; each
+        # early snapshot stands in for at most one second, since the snapshot
+        # threads never snapshot more often than that
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        conn = collectd.Connection(**limits)
+        early_packets = regular_packets = 0
+        for interval in range(10):
+            for burst in range(4):
+                for i in range(500):
+                    conn.burst.record("s{0}_{1}_{2}".format(interval, burst, i), hits = 1)
+                    if collectd.flush_requested.is_set():
+                        collectd.take_snapshots(early = True)
+                        for stats in self.queued():
+                            early_packets = max(early_packets, len(collectd.messages(stats)))
+            
+            collectd.take_snapshots()
+            regular_packets = sum(len(collectd.messages(stats)) for stats in self.queued())
+        used = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+        results.put((used, early_packets, regular_packets))
+    
+    # each burst runs in a fresh process so that its peak memory usage
+    # isn't hidden by whatever this process has already allocated
+    def run_burst(self, **limits):
+        results = multiprocessing.Queue()
+        child = multiprocessing.Process(target = self.burst, args = (limits, results))
+        child.start()
+        result = results.get(timeout = 60)
+        child.join()
+        return result
+    
+    def test_bursty_workload(self):
+        unlimited, early, regular = self.run_burst()
+        self.assertEqual(0, early)
+        self.assertTrue(regular > 700)
+        
+        limited, early, regular = self.run_burst(max_pending_series = 100)
+        self.assertTrue(early <= 5)
+        self.assertTrue(regular <= 5)
+        self.assertTrue(limited < unlimited / 2)
+        
+        limited, early, regular = self.run_burst(max_pending_bytes = 4096)
+        self.assertTrue(early <= 5)
+        self.assertTrue(regular <= 5)
+        self.assertTrue(limited < unlimited / 2)
+
 
 class NullHandler(logging.Handler):
     def emit(self, record):